@@ -8,56 +8,168 @@
 # Imports:
 import random
 from random import randint
-from time import sleep
-import urllib.request
+from time import sleep, time
 import json
+import os
+import re
 import argparse
 import sys
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # 3rd party additional imports:
 import argcomplete
+import requests
+from requests.adapters import HTTPAdapter
 from twilio.rest import Client
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 
-def extract_values(obj, key):
-    """This function, being data-agnostic, extracts all key-values found in any multilevel JSON file, without knowing the order/hierarchy of the data.
-    Obtained from: https://hackersandslackers.com/extract-data-from-complex-json-python/
-    Pull all values of specified key from nested JSON."""
-    arr = []
-
-    def extract(obj, arr, key):
-        """Recursively search for values of key in JSON tree."""
-        if isinstance(obj, dict):
-            for k, v in obj.items():
-                if isinstance(v, (dict, list)):
-                    extract(v, arr, key)
-                elif k == key:
-                    arr.append(v)
-        elif isinstance(obj, list):
-            for item in obj:
-                extract(item, arr, key)
-        return arr
-    results = extract(obj, arr, key)
-    return results
+def hebcal_items(response):
+    """This function flattens the items of a hebcal.com response into
+    (category, title) pairs."""
+    if response == '':
+        return []
+    return [(item.get('category'), item.get('title', '')) for item in response.get('items', [])]
+
+
+def first_title(items, category, default=None):
+    """This function finds the title of the first hebcal.com item in a
+    category, or returns the default if there is none."""
+    return next((title for item_category, title in items if item_category == category), default)
+
+
+def weather_descriptions(weather_response):
+    """This function lists the weather descriptions of an openweathermap.org
+    response."""
+    if weather_response == '':
+        return []
+    return [weather.get('description', '') for weather in weather_response.get('weather', [])]
 
 
 def shorten_message(message):
-    """This function recursively tries to shorten a message
+    """This function tries to shorten a message
     to under 160 characters"""
-    if len(message) <= 160:
-        return message
-    else:
-        if ' (50 min)' in message:
-            return shorten_message(message.replace(' (50 min)', ''))
-        else:
-            # Warn if message still exceeds 160 characters:
-            print(
-                'Message for ' +
-                city +
-                ' exceeds 160 character limit!\nMessage: ' +
-                message)
-            return message
+    while len(message) > 160 and ' (50 min)' in message:
+        message = message.replace(' (50 min)', '', 1)
+
+    # Warn if message still exceeds 160 characters:
+    if len(message) > 160:
+        print(f'Message for {city} exceeds 160 character limit!\nMessage: {message}')
+    return message
+
+def sheet_columns(value_range, width):
+    """This function transposes the rows of a batchGet value range into a list
+    per column. Google omits trailing empty cells, so short rows are padded."""
+    rows = [row + [''] * (width - len(row)) for row in value_range.get('values', [])]
+    return [list(column) for column in zip(*rows)] if rows else [[] for _ in range(width)]
+
+def is_value_range(value_range):
+    """This function checks that cached data has the shape of a batchGet value
+    range, i.e. a dict whose values are rows of text cells."""
+    if not isinstance(value_range, dict) or not isinstance(value_range.get('values', []), list):
+        return False
+    return all(isinstance(row, list) and all(isinstance(cell, str) for cell in row)
+               for row in value_range.get('values', []))
+
+def fetch_json(url):
+    """This function downloads and decodes a JSON document using the shared
+    HTTP session, so connections are kept alive between requests."""
+    response = session.get(url, timeout=15)
+    response.raise_for_status()
+
+    # Parse the raw bytes directly, skipping a separate decode to text:
+    return json.loads(response.content)
+
+def load_cache(path):
+    """This function loads data from a cache file, or returns None if the file
+    is missing, unreadable or corrupt (so the data is downloaded instead)."""
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+def save_cache(path, data):
+    """This function saves data to a cache file that only the owner can read,
+    since cached data may contain phone numbers. The data is written to a
+    temporary file first, so an interrupted write never leaves a truncated cache."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with open(descriptor, 'w') as file:
+            json.dump(data, file)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+def fresh_reports(cache):
+    """This function keeps the reports of a loaded report cache that are
+    well-formed [timestamp, report] pairs younger than their time to live
+    (capped at --cache-ttl), so corrupt and stale entries are dropped."""
+    fresh = {}
+    if not isinstance(cache, dict):
+        return fresh
+    for zipcode, reports in cache.items():
+        if not isinstance(reports, dict):
+            continue
+        for kind, cached in reports.items():
+            if (kind in report_cache_ttls and isinstance(cached, list) and len(cached) == 2
+                    and isinstance(cached[0], (int, float)) and isinstance(cached[1], dict)
+                    and time() - cached[0] < min(report_cache_ttls[kind], arguments.cache_ttl)):
+                fresh.setdefault(zipcode, {})[kind] = cached
+    return fresh
+
+def cached_report(zipcode, kind):
+    """This function returns the cached hebcal or weather report of a zipcode,
+    or None if there is no fresh one."""
+    cached = report_cache.get(str(zipcode), {}).get(kind)
+    return cached[1] if cached else None
+
+def fetch_city_reports(zipcode):
+    """This function fetches the hebcal.com times and openweathermap.org weather
+    for a zipcode, unless they're cached. Either is left as an empty string if
+    it isn't needed."""
+    response = ''
+    if not ((arguments.no_candlelighting and arguments.no_havdalah) or arguments.custom_message):
+        response = cached_report(zipcode, 'hebcal') or fetch_json(
+            'https://www.hebcal.com/shabbat/?cfg=json&zip=' +
+            str(zipcode) +
+            '&m=50&a=on')
+    weather_response = ''
+    if not (arguments.no_weather or arguments.custom_message):
+        weather_response = cached_report(zipcode, 'weather') or fetch_json(
+            'https://api.openweathermap.org/data/2.5/weather?zip=' +
+            str(zipcode) +
+            ',us&appid=' +
+            open_weather_map['api-key'])
+    return response, weather_response
+
+def gets_sms(subscription):
+    """This function checks whether a subscriber gets an SMS, which non-SMS
+    subscribers only do if --include-non-sms is requested."""
+    return subscription.lower() == 'sms' or arguments.include_non_sms
+
+def clean_phone_number(number):
+    """This function sanitizes a phone number from anything but digits in a
+    single pass and adds the US country code."""
+    return '+1' + non_digits.sub('', str(number))
+
+def get_twilio_client():
+    """This function authenticates with Twilio the first time it's needed,
+    so test runs and --available-cities never do."""
+    global client
+    if client is None:
+        client = Client(twilio_file['account-sid'], twilio_file['password'])
+
+        # Keep a connection alive for every send worker, instead of requests'
+        # default of 10, so Twilio connections are reused rather than reopened:
+        client.http_client.session.mount('https://', HTTPAdapter(pool_maxsize=sms_workers))
+        if arguments.verbose:
+            print('Twilio Authenticated successfully.\n')
+    return client
 
 def army_to_meridian(input_time):
     if 'am' in input_time.lower() or 'pm' in input_time.lower():
@@ -83,6 +195,25 @@ def army_to_meridian(input_time):
 # Define a list of random greetings to reduce spam detection and add variety:
 greetings = ['a great', 'a wonderful', 'an amazing', 'a good']
 
+# Define the weather descriptions that warrant warning users to be vigilant:
+storm_pattern = re.compile('thunderstorm|tornado')
+
+# Define how many seconds cached hebcal.com and openweathermap.org reports
+# stay fresh (candle-lighting times rarely change, the weather often does):
+report_cache_ttls = {'hebcal': 3600, 'weather': 300}
+
+# Define how many hebcal.com/openweathermap.org requests may run at once:
+fetch_workers = 16
+
+# Define how many SMS messages may be sent to Twilio at once:
+sms_workers = 32
+
+# Define how many users a single Twilio Notify request may be sent to:
+notify_batch_size = 1000
+
+# Define the characters removed from phone numbers (anything but digits):
+non_digits = re.compile(r'\D')
+
 # Initialize argument interpretation:
 parser = argparse.ArgumentParser(
     description='This script sends SMS messages via Twilio to subscribers on a Google Sheet.')
@@ -98,6 +229,11 @@ parser.add_argument(
     '--blacklist',
     nargs='+',
     help='Append a list of cities (space delimited) to skip alerting (cities with 2+ names should be enclosed in quotes). Available cities can be found using the --available-cities flag. This argument will override the whitelist argument.')
+parser.add_argument(
+    '--cache-ttl',
+    type=int,
+    metavar='SECONDS',
+    help='Reuse the Google Sheets data cached on disk (in ~/.cache/eruv_alerts) if it is newer than this many seconds, instead of downloading it again. Subscribers added or removed since then will be missed. This also reuses hebcal.com reports up to an hour old and weather reports up to 5 minutes old (or up to this many seconds, if fewer).')
 parser.add_argument(
     '--custom-message',
     action='append',
@@ -135,6 +271,10 @@ parser.add_argument(
     '--phone',
     action='append',
     help='Sends an SMS to a single phone number instead of a group. This argument requires a custom message as well.')
+parser.add_argument(
+    '--refresh-cache',
+    action='store_true',
+    help='Download the Google Sheets data and reports even if they are cached, and update the cache.')
 parser.add_argument(
     '--test',
     action='store_true',
@@ -188,68 +328,92 @@ if arguments.verbose:
     if arguments.append and not arguments.custom_message:
         print('An appended message will be sent out along with the regular message!\n')
 
-# Google Authentication from external JSON file:
-scope = ['https://spreadsheets.google.com/feeds',
-         'https://www.googleapis.com/auth/drive']
-creds = ServiceAccountCredentials.from_json_keyfile_name(
-    'keys/google_auth.json', scope)
-gclient = gspread.authorize(creds)
-if arguments.verbose:
-    print('Google Authenticated successfully.\n')
-
-# Twilio Authentication from external JSON file:
+# Load Twilio Authentication from external JSON file (the client itself is
+# only authenticated once something is actually sent):
 with open('keys/twilio_auth.json') as file:
     twilio_file = json.load(file)
-client = Client(twilio_file['account-sid'], twilio_file['password'])
-if arguments.verbose:
-    print('Twilio Authenticated successfully.\n')
+client = None
 
 # Load Open Weather Map Authentication from external JSON file:
 with open('keys/open_weather_map.json') as file:
     open_weather_map = json.load(file)
 
-# Send single SMS and exit:
-if arguments.phone:
-    message = ''.join(str(elem) for elem in arguments.custom_message)
+# Share one HTTP session so connections to hebcal.com and openweathermap.org
+# are reused across cities. Keep one pool per host, each large enough for
+# every fetch worker, so no kept-alive connection is discarded:
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=fetch_workers))
+
+# Build the requested custom message and the text added to the end of every
+# message once:
+custom_message = ''
+if arguments.custom_message:
+    custom_message = ''.join(str(elem) for elem in arguments.custom_message)
+message_suffix = ''
 
-    # Append donate message if requested (links may be flagged as spam):
-    if arguments.donate:
-        message = message + ' Please visit bit.ly/nmberuv to cover the costs.'
+# Append donate message if requested (links may be flagged as spam):
+if arguments.donate:
+    message_suffix += ' Please visit bit.ly/nmberuv to cover the costs.'
 
-    # Add appended message if requested:
-    if arguments.append:
-        message = message + ' ' + ''.join(str(elem) for elem in arguments.append).strip()
+# Add appended message if requested:
+if arguments.append:
+    message_suffix += ' ' + ''.join(str(elem) for elem in arguments.append).strip()
+
+# Send single SMS and exit:
+if arguments.phone:
+    message = custom_message + message_suffix
 
     # Sanitize the phone number from special characters:
-    clean_number = '+1' + str(
-        ''.join(str(elem) for elem in arguments.phone)).replace("-", "").replace(" ", "").replace("(", "").replace(")", "").replace(".", "").replace("_", "")
+    clean_number = clean_phone_number(''.join(str(elem) for elem in arguments.phone))
     if arguments.test:
         print('"' + message + '" would have been sent to: ' + clean_number)
     else:
-        twilio_message = client.messages.create(
+        twilio_message = get_twilio_client().messages.create(
             to=clean_number, from_=twilio_file['phone'], body=message)
         print('"' + message + '" was sent to: ' + clean_number)
     quit()
 
-# Load lists from sheets:
-subscriber_sheet = gclient.open('Eruv List').worksheet('Subscribers')
-rabbi_sheet = gclient.open('Eruv List').worksheet('Rabbis')
-status_sheet = gclient.open('Eruv List').worksheet('Status')
-if arguments.verbose:
-    print('Google Sheets loaded successfully.\n')
-
-# Create arrays of all elements from the sheets. Skip top row (Timestamp,
-# Phone Number, City, Rabbi's City, Zip Code):
-all_numbers = subscriber_sheet.col_values(2)[1:]
-all_user_cities = subscriber_sheet.col_values(3)[1:]
-non_sms_list = subscriber_sheet.col_values(4)[1:]
-# Catch in case there are no non SMS entries (list must be same size as other list, not 0):
-if len(non_sms_list) == 0:
-    non_sms_list = [''] * len(subscriber_sheet.col_values(2)[1:])
-all_rabbi_cities = rabbi_sheet.col_values(3)[1:]
-all_rabbi_zipcodes = rabbi_sheet.col_values(4)[1:]
-all_cities = status_sheet.col_values(1)
-city_statuses = status_sheet.col_values(2)
+# Load all columns from the sheets, from the cache if it's fresh enough:
+sheet_cache = os.path.expanduser('~/.cache/eruv_alerts/sheets.json')
+value_ranges = None
+if arguments.cache_ttl and not arguments.refresh_cache and os.path.exists(
+        sheet_cache) and time() - os.path.getmtime(sheet_cache) < arguments.cache_ttl:
+    value_ranges = load_cache(sheet_cache)
+
+    # Ignore a corrupt cache (it doesn't hold the three ranges):
+    if not isinstance(value_ranges, list) or len(value_ranges) != 3 or not all(
+            is_value_range(value_range) for value_range in value_ranges):
+        value_ranges = None
+    elif arguments.verbose:
+        print('Google Sheets loaded from cache.\n')
+if value_ranges is None:
+
+    # Otherwise authenticate with Google from external JSON file:
+    scope = ['https://spreadsheets.google.com/feeds',
+             'https://www.googleapis.com/auth/drive']
+    creds = ServiceAccountCredentials.from_json_keyfile_name(
+        'keys/google_auth.json', scope)
+    gclient = gspread.authorize(creds)
+    if arguments.verbose:
+        print('Google Authenticated successfully.\n')
+
+    # Load them in a single batched request. Skip top row (Timestamp, Phone
+    # Number, City, Rabbi's City, Zip Code) of Subscribers and Rabbis:
+    spreadsheet = gclient.open('Eruv List')
+    value_ranges = spreadsheet.values_batch_get(
+        ['Subscribers!B2:D', 'Rabbis!C2:D', 'Status!A:B'])['valueRanges']
+    if arguments.verbose:
+        print('Google Sheets loaded successfully.\n')
+
+    # Save the sheets for later runs:
+    if arguments.cache_ttl or arguments.refresh_cache:
+        save_cache(sheet_cache, value_ranges)
+subscriber_range, rabbi_range, status_range = value_ranges
+
+# Create arrays of all elements from the sheets:
+all_numbers, all_user_cities, non_sms_list = sheet_columns(subscriber_range, 3)
+all_rabbi_cities, all_rabbi_zipcodes = sheet_columns(rabbi_range, 2)
+all_cities, city_statuses = sheet_columns(status_range, 2)
 if arguments.verbose:
     print('Cities loaded successfully.\n')
 
@@ -258,105 +422,131 @@ if arguments.available_cities:
     print(all_cities)
     quit()
 
-# For each city in Status Sheet:
-city_index = 0
+# Map each rabbi's city to its zipcode (the first listing of a city wins):
+city_zipcodes = {}
+for rabbi_city, zipcode in zip(all_rabbi_cities, all_rabbi_zipcodes):
+    city_zipcodes.setdefault(rabbi_city, zipcode)
+
+# Map each city to the (phone number, subscription type) of every subscriber
+# that listed it:
+users_by_city = defaultdict(list)
+for number, user_cities, subscription in zip(all_numbers, all_user_cities, non_sms_list):
+    for user_city in user_cities.split(','):
+        users_by_city[user_city.strip()].append((number, subscription))
 
-for city in all_cities:
+# Casefold the blacklisted and whitelisted cities once (case insensitive,
+# including non-ASCII names):
+blacklisted_cities = frozenset(x.casefold() for x in arguments.blacklist or [])
+whitelisted_cities = frozenset(x.casefold() for x in arguments.whitelist or [])
+
+# Collect each city in Status Sheet that should be alerted, with its zipcode:
+alert_cities = []
+for city, status in zip(all_cities, city_statuses):
 
     # Skip if city is being ignored (case insensitive):
-    if arguments.blacklist:
-        if city.lower() in [x.lower() for x in arguments.blacklist]:
-            print('\nSkipping ' + str(city) + " because it's blacklisted!\n")
-            city_index += 1
-            continue
+    if city.casefold() in blacklisted_cities:
+        print('\nSkipping ' + str(city) + " because it's blacklisted!\n")
+        continue
 
     # Skip if whitelist enabled and city isn't whitelisted (case insensitive):
-    if arguments.whitelist:
-        if not city.lower() in [x.lower() for x in arguments.whitelist]:
-            print(
-                '\nSkipping ' +
-                str(city) +
-                " because it isn't whitelisted!\n")
-            city_index += 1
-            continue
+    if whitelisted_cities and city.casefold() not in whitelisted_cities:
+        print(
+            '\nSkipping ' +
+            str(city) +
+            " because it isn't whitelisted!\n")
+        continue
 
     # Skip if the city status is Pending unless requested otherwise:
-    if city_statuses[city_index] == 'Pending' and not arguments.override_pending:
+    if status == 'Pending' and not arguments.override_pending:
         print('\nSkipping ' + str(city) + " because it's still pending!\n")
-        city_index += 1
         continue
 
     # Get zipcode of city:
-    zip_index = 0
-    zipcode = 0
-    for rabbi_city in all_rabbi_cities:
-        if rabbi_city == city:
-            zipcode = all_rabbi_zipcodes[zip_index]
-            break
-        zip_index += 1
+    zipcode = city_zipcodes.get(city, 0)
 
     # Catch invalid Zip Code:
     if zipcode == 0:
         print('\nInvalid zipcode detected for ' + city + '!\n')
         quit()
 
-    # Get Candle-lighting, Havdalah, and Parsha/Chag from hebcal.com:
-    hebcal_URL = 'https://www.hebcal.com/shabbat/?cfg=json&zip=' + \
-        str(zipcode) + '&m=50&a=on'
-    response = ''
+    # Skip if nobody would be notified in the city, so its reports aren't fetched:
+    if not any(gets_sms(subscription) for _, subscription in users_by_city.get(city, ())):
+        print('\nSkipping ' + str(city) + " because it has no subscribers to notify!\n")
+        continue
 
-    # Skip checking times if requested:
+    alert_cities.append((city, status, zipcode))
+
+# Load the reports fetched on recent cached runs that are still fresh (a missing
+# or corrupt cache is simply ignored, and stale reports aren't saved again):
+report_cache_file = os.path.expanduser('~/.cache/eruv_alerts/reports.json')
+report_cache = {}
+if arguments.cache_ttl and not arguments.refresh_cache:
+    report_cache = fresh_reports(load_cache(report_cache_file))
+
+# Get Candle-lighting, Havdalah, Parsha/Chag from hebcal.com and the weather from
+# openweathermap.org for all cities at once, since each request mostly waits on the network.
+# Cities sharing a zipcode share the same reports, so each zipcode is only fetched once:
+zipcodes = list(dict.fromkeys(zipcode for _, _, zipcode in alert_cities))
+with ThreadPoolExecutor(max_workers=fetch_workers) as executor:
+    zipcode_reports = dict(zip(zipcodes, executor.map(fetch_city_reports, zipcodes)))
+
+# Save the newly fetched reports for later runs:
+if arguments.cache_ttl or arguments.refresh_cache:
+    for zipcode, reports in zipcode_reports.items():
+        for kind, report in zip(('hebcal', 'weather'), reports):
+            if report != '' and cached_report(zipcode, kind) is None:
+                report_cache.setdefault(str(zipcode), {})[kind] = [time(), report]
+    save_cache(report_cache_file, report_cache)
+
+# Send SMS messages in the background so Twilio requests overlap, unless
+# they're being delayed on purpose:
+sms_pool = ThreadPoolExecutor(max_workers=sms_workers)
+
+# Keep track of the numbers each background send is for, and of every number
+# that couldn't be sent to:
+sms_futures = {}
+failed_numbers = []
+
+# For each city to alert:
+for city, status, zipcode in alert_cities:
+    response, weather_response = zipcode_reports[zipcode]
+
+    # Report that times weren't fetched, if they were skipped as requested:
     if (arguments.no_candlelighting and arguments.no_havdalah) or arguments.custom_message:
         print('\nSkipping candlelighting and Havdalah times!\n')
-    else:
-        response = json.loads(
-            urllib.request.urlopen(
-                hebcal_URL,
-                timeout=15).read().decode('utf-8'))
 
-    # Find first occurrence of Candle-lighting from JSON:
-    candle_lighting = ''
-    if response != '':
-        candle_lighting = [
-            i for i in extract_values(
-                response,
-                'title') if 'Candle' in i][0]
+    # Flatten the hebcal items into (category, title) pairs once:
+    items = hebcal_items(response)
 
-    # Detects and converts army times to Meridian:
-    if candle_lighting != '':
-        candle_lighting = candle_lighting.rsplit(' ', 1)[0] + ' ' + army_to_meridian(candle_lighting.rsplit(' ', 1)[1])
-        candle_lighting += '. '
+    # Find first occurrence of Candle-lighting from JSON, unless skipped:
+    candle_lighting = ''
+    candle_lighting_title = first_title(items, 'candles')
+    if not arguments.no_candlelighting and candle_lighting_title:
 
-    # Skip candlelighting if requested:
-        if arguments.no_candlelighting:
-            candle_lighting = ''
+        # Detects and converts army times to Meridian:
+        title, title_time = candle_lighting_title.rsplit(' ', 1)
+        candle_lighting = title + ' ' + army_to_meridian(title_time) + '. '
 
     # Find first occurrence of Havdalah from JSON only if Havdalah exists:
     havdalah = ''
 
     # Verify there's a Havdalah entry first:
-    if not arguments.no_havdalah and len([i for i in extract_values(response, 'title') if 'Havdalah' in i]) > 0:
-        havdalah = [
-            i for i in extract_values(
-                response,
-                'title') if 'Havdalah' in i][0]
+    havdalah_title = first_title(items, 'havdalah')
+    if not arguments.no_havdalah and havdalah_title:
 
         # Detects and converts army times to Meridian:
-        havdalah = havdalah.rsplit(' ', 1)[0] + ' ' + army_to_meridian(havdalah.rsplit(' ', 1)[1])
-
-        havdalah = havdalah + '. '
+        title, title_time = havdalah_title.rsplit(' ', 1)
+        havdalah = title + ' ' + army_to_meridian(title_time) + '. '
 
     # Store if holiday:
     holiday = ''
 
     # Check if any Parsha is listed in JSON:
-    if [i for i in extract_values(response, 'title') if 'Parsha' in i]:
+    parsha_title = first_title(items, 'parashat')
+    if parsha_title:
 
         # Find first occurrence of Parsha from JSON:
-        parsha = [
-            i for i in extract_values(
-                response,
-                'title') if 'Parsha' in i][0] + '.'
+        parsha = parsha_title + '.'
 
     else:
 
@@ -368,19 +558,11 @@ for city in all_cities:
         havdalah = ''
 
     # If there's a thunderstorm or tornado, warn users to be vigilant:
-    weather_response = ''
     temperature = ''
     humidity = ''
     if arguments.no_weather or arguments.custom_message:
         print('\nNo weather is being reported!\n')
     else:
-        weather_response = json.loads(
-            urllib.request.urlopen(
-                'https://api.openweathermap.org/data/2.5/weather?zip=' +
-                str(zipcode) +
-                ',us&appid=' +
-                open_weather_map['api-key'],
-                timeout=15).read().decode('utf-8'))
         temperature = 'Temperature: ' + \
             str(int(1.8 * (weather_response['main']['temp'] - 273.15) + 32)) + 'F'
         humidity = str(weather_response['main']['humidity']) + '% humid'
@@ -392,74 +574,104 @@ for city in all_cities:
     prequel = ' The '
     sequel = ''
 
-    if [i for i in extract_values(weather_response, 'description') if 'thunderstorm' in i or 'tornado' in i] or arguments.weather and not arguments.no_weather:
+    descriptions = weather_descriptions(weather_response)
+    if any(storm_pattern.search(i) for i in descriptions) or arguments.weather and not arguments.no_weather:
         print('Weather will be reported!\n')
         print('Reported temperature for ' + city + ': ' + temperature + '\n')
         print('Reported humidity for ' + city + ': ' + humidity + '\n')
         prequel = ' As of now, the '
         sequel = '. If winds exceed 35 mph, consider the Eruv down'
 
+    # Final messages, built once per city. Without a weather warning there's
+    # one variant per greeting, and each user gets a random one:
+    if arguments.custom_message:
+
+        # Override message with custom message if requested:
+        city_messages = [custom_message]
+    elif sequel == '':
+        city_messages = [
+            f'{parsha}{prequel}{city} Eruv is {status}. {candle_lighting}{havdalah}Have {greeting} Shabbos{holiday}!'
+            for greeting in greetings]
+    else:
+        city_messages = [f'{parsha}{prequel}{city} Eruv is {status}{sequel}. {candle_lighting}{havdalah}']
+
+    # Try to shorten the messages & remove whitespace if necessary:
+    if not arguments.custom_message:
+        city_messages = [shorten_message(message).strip() for message in city_messages]
+
+    # Add the donate and appended messages if requested:
+    city_messages = [message + message_suffix for message in city_messages]
+
     # Loop through all users from city and send:
-    user_index = 0
     population = 0
-    for city_found in all_user_cities:
-        for city_item in [x.strip() for x in city_found.split(',')]:
-            if city == city_item:
-
-                # Skip if user isn't subscribed via SMS, unless requested:
-                if non_sms_list[user_index].lower() != 'sms':
-                    if arguments.include_non_sms:
-                        print('\nSending SMS to a non-SMS number!\n')
-                    else:
-                        continue
-
-                # Final message:
-                message = parsha + prequel + city + ' Eruv is ' + city_statuses[city_index] + sequel + '. ' + candle_lighting + havdalah + (
-                    'Have ' + random.choice(greetings) + ' Shabbos' + holiday + '!' if sequel == '' else '')
-
-                # Try to shorten the message & remove whitespace if necessary:
-                message = shorten_message(message).strip()
-
-                # Override message with custom message if requested:
-                if arguments.custom_message:
-                    message = ''.join(str(elem) for elem in arguments.custom_message)
-
-                # Append donate message if requested (links may be flagged as spam):
-                if arguments.donate:
-                    message = message + ' Please visit bit.ly/nmberuv to cover the costs.'
-
-                # Add appended message if requested:
-                if arguments.append:
-                    message = message + ' ' + ''.join(str(elem) for elem in arguments.append).strip()
-
-                # Sanitize the phone number from special characters:
-                clean_number = '+1' + str(
-                    all_numbers[user_index]).replace("-", "").replace(" ", "").replace("(", "").replace(")", "").replace(".", "").replace("_", "")
-
-                # Display and send:
-                if arguments.verbose:
-                    print(clean_number + ' > ' + message)
-
-                # Send if no testing argument:
-                if not arguments.test:
-                    twilio_message = client.messages.create(
-                        to=clean_number, from_=twilio_file['phone'], body=message)
+    notify_numbers = defaultdict(list)
+    for number, subscription in users_by_city.get(city, ()):
+
+        # Skip if user isn't subscribed via SMS, unless requested:
+        if not gets_sms(subscription):
+            continue
+
+        # Warn when sending to a non-SMS subscriber:
+        if subscription.lower() != 'sms':
+            print('\nSending SMS to a non-SMS number!\n')
 
-                # Wait a random amount of seconds between sending (0 - 2
-                # seconds):
-                if arguments.delayed:
-                    sleep(randint(0, 2))
+        # Final message:
+        message = random.choice(city_messages)
 
-                # Keep track of total # of users:
-                population += 1
+        # Sanitize the phone number from special characters:
+        clean_number = clean_phone_number(number)
 
-        # Keep track of current index of user:
-        user_index += 1
+        # Display and send:
+        if arguments.verbose:
+            print(f'{clean_number} > {message}')
 
-    print('\n' +
-        str(population) +
-        ' users ' +
-        ('would have been ' if arguments.test else '') +
-        'notified' +
-        (': "' + message + '"' if arguments.custom_message else ' that ' + city + ' is ' + city_statuses[city_index] + '.') + '\n')
-    city_index += 1
+        # Send if no testing argument:
+        if not arguments.test:
+            if arguments.delayed:
+                try:
+                    get_twilio_client().messages.create(
+                        to=clean_number, from_=twilio_file['phone'], body=message)
+                except Exception as error:
+                    print(f'\nFailed to send to {clean_number}: {error}\n')
+                    failed_numbers.append(clean_number)
+            elif 'notify-service-sid' in twilio_file:
+                notify_numbers[message].append(clean_number)
+            else:
+                sms_futures[sms_pool.submit(
+                    get_twilio_client().messages.create,
+                    to=clean_number, from_=twilio_file['phone'], body=message)] = [clean_number]
+
+        # Wait a random amount of seconds between sending (0 - 2 seconds):
+        if arguments.delayed:
+            sleep(randint(0, 2))
+
+        # Keep track of total # of users:
+        population += 1
+
+    # Send each distinct message to all of its users with one Notify request
+    # per batch (Twilio caps the number of bindings per notification):
+    for message, numbers in notify_numbers.items():
+        notify_service = get_twilio_client().notify.services(twilio_file['notify-service-sid'])
+        for batch in range(0, len(numbers), notify_batch_size):
+            batch_numbers = numbers[batch:batch + notify_batch_size]
+            bindings = [json.dumps({'binding_type': 'sms', 'address': number})
+                        for number in batch_numbers]
+            sms_futures[sms_pool.submit(
+                notify_service.notifications.create, to_binding=bindings, body=message)] = batch_numbers
+
+    notified = f': "{city_messages[0]}"' if arguments.custom_message else f' that {city} is {status}.'
+    print(f"\n{population} users {'would have been ' if arguments.test else ''}notified{notified}\n")
+
+# Wait for all SMS messages to finish sending, reporting every one that failed
+# instead of stopping at the first Twilio error:
+for future in as_completed(sms_futures):
+    try:
+        future.result()
+    except Exception as error:
+        print(f'\nFailed to send to {", ".join(sms_futures[future])}: {error}\n')
+        failed_numbers.extend(sms_futures[future])
+sms_pool.shutdown()
+
+# Summarize the failures, since the counts above include them:
+if failed_numbers:
+    print(f'\n{len(failed_numbers)} messages could not be sent, to: {failed_numbers}\n')